@@ -1,19 +1,22 @@
 import base64
+from channel_memory import ChannelMemory, HashingEmbedder
 import math
 import os
-from speech_generation import Voice
-from text_generation import Chat
-from static_ffmpeg import run
+from speech_generation import OggOpusSource, SpeechPipeline, Voice, encode_ogg_opus
+from response_cache import ResponseCache
+from text_generation import Chat, CircuitOpenError
+from usage_ledger import GROUP_COLUMNS, UsageLedger
 from io import BytesIO
 import re
 import asyncio
 import json
-from typing import Any, Callable, Dict, List, Optional, Set, TypedDict
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple, TypedDict
 import json
 import discord
 from discord.ext import commands
 from logging import getLogger
 from logging_config import setup_logger
+from loop_watchdog import LoopWatchdog, profile_loop
 
 setup_logger()
 
@@ -43,6 +46,21 @@ ALLOWED_CHOICES = config.get("allowed_tool_choice", None)
 # General items that normally won't be defined
 MAX_HISTORY_LENGTH = config.get("max_history_length", 100)
 MAX_IMAGE_COUNT = config.get("max_image_count", 100)
+MAX_MEMORY_COUNT = config.get("max_memory_count", 20)
+MEMORY_DIRECTORY = config.get("memory_directory", "data/memory")
+MEMORY_EMBEDDING = config.get("memory_embedding", "openai")
+MAX_RECALL_CHARACTERS = config.get("max_recall_characters", 500)
+RESPONSE_CACHE_SIZE = config.get("response_cache_size", 128)
+RESPONSE_CACHE_TTL = config.get("response_cache_ttl", 3600)
+RESPONSE_CACHE_BYTES = config.get("response_cache_bytes", 32 * 1024 * 1024)
+LOOP_STALL_THRESHOLD = config.get("loop_stall_threshold", 0.5)
+MAX_PROFILE_DURATION = config.get("max_profile_duration", 60)
+USAGE_DATABASE = config.get("usage_database", "data/usage.sqlite3")
+DAILY_TOKEN_BUDGET_CHANNEL = config.get("daily_token_budget_channel", None)
+DAILY_TOKEN_BUDGET_USER = config.get("daily_token_budget_user", None)
+DAILY_CHARACTER_BUDGET_CHANNEL = config.get(
+    "daily_character_budget_channel", None)
+DAILY_CHARACTER_BUDGET_USER = config.get("daily_character_budget_user", None)
 # Constants
 MAX_MESSAGE_SIZE = 2000  # Discord message length maximum
 
@@ -71,6 +89,13 @@ PARAMETER_LIST: List[CustomParameter] = [
         'type': int,
         'validator': lambda v: 0 <= v < 100,
     },
+    {
+        'name': 'memory_count',
+        'description': "Amount of relevant older messages to recall from beyond the history (0=off).",
+        'category': "history",
+        'type': int,
+        'validator': lambda v: 0 <= v <= MAX_MEMORY_COUNT,
+    },
     {
         'name': 'system_message',
         'description': "Permanent system message the AI should adhere to (max 1000 characters).",
@@ -113,6 +138,12 @@ PARAMETER_LIST: List[CustomParameter] = [
         'type': str,
         'options': ALLOWED_CHOICES,
     },
+    {
+        'name': 'response_cache',
+        'description': "If identical requests should be answered from cache (useful with temperature 0).",
+        'category': "generation",
+        'type': bool,
+    },
     {
         'name': 'voice',
         'description': "If the bot should be able to respond in voice channel from this chat.",
@@ -126,8 +157,32 @@ intents = discord.Intents.default()
 intents.message_content = True
 
 client = commands.Bot(command_prefix=COMMAND_PREFIX, intents=intents)
-chatgpt = Chat(OPENAI_TOKEN, MODEL_DEFAULT)
+loop_watchdog = LoopWatchdog(LOOP_STALL_THRESHOLD)
+chatgpt = Chat(OPENAI_TOKEN, MODEL_DEFAULT,
+               response_cache=ResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL, RESPONSE_CACHE_BYTES))
 elevenlabs = Voice(ELEVENLABS_TOKEN)
+usage_ledger = UsageLedger(USAGE_DATABASE,
+                           channel_token_budget=DAILY_TOKEN_BUDGET_CHANNEL,
+                           user_token_budget=DAILY_TOKEN_BUDGET_USER,
+                           channel_character_budget=DAILY_CHARACTER_BUDGET_CHANNEL,
+                           user_character_budget=DAILY_CHARACTER_BUDGET_USER)
+
+try:
+    not_enough_tokens_audio = encode_ogg_opus("not_enough_tokens.mp3")
+except Exception as e:
+    bot_logger.error(f"Cannot encode not_enough_tokens.mp3: {e}")
+    not_enough_tokens_audio = None
+
+if MEMORY_EMBEDDING == "local":
+    memory_embedder = HashingEmbedder()
+    channel_memory = ChannelMemory(
+        memory_embedder, memory_embedder.dimension, "local", MEMORY_DIRECTORY)
+else:
+    channel_memory = ChannelMemory(
+        chatgpt.get_embeddings_async, 1536, "text-embedding-3-small", MEMORY_DIRECTORY)
+
+# In-flight generations per channel, keyed by the triggering message id
+generation_tasks: Dict[int, Dict[int, asyncio.Task]] = dict()
 
 
 @client.tree.command()
@@ -139,6 +194,9 @@ async def kill(context: discord.Interaction):
                     f" in guild {context.guild.name} ({context.guild.id})"
                     f" in channel {context.channel.name} ({context.channel.id})")
     try:
+        loop_watchdog.stop()
+        await asyncio.wait_for(usage_ledger.close(), timeout=5)
+        await asyncio.wait_for(chatgpt.close(), timeout=5)
         await asyncio.wait_for(client.close(), timeout=5)
         bot_logger.info("Bot has shut down gracefully")
     except asyncio.TimeoutError:
@@ -147,6 +205,73 @@ async def kill(context: discord.Interaction):
         os._exit(0)
 
 
+@client.tree.command(name="usage", description="Show API usage of the last days (admin only).")
+@discord.app_commands.describe(
+    group_by="Aggregate usage by channel, user or model",
+    days="Amount of days to include (default 1)"
+)
+@discord.app_commands.choices(
+    group_by=[
+        discord.app_commands.Choice(name=column, value=column)
+        for column in GROUP_COLUMNS
+    ]
+)
+async def usage(
+    interaction: discord.Interaction,
+    group_by: discord.app_commands.Choice[str],
+    days: int = 1
+):
+    """Show aggregated API usage."""
+    if ADMIN_USER_ID is not None and interaction.user.id != int(ADMIN_USER_ID):
+        return await interaction.response.send_message(
+            "You do not have permission to use this command.", ephemeral=True)
+    await interaction.response.defer(ephemeral=True)
+    rows = await usage_ledger.query(group_by.value, days)
+    cache_line = f"Response cache: {chatgpt.response_cache.hits} hits / {chatgpt.response_cache.misses} misses"
+    if len(rows) == 0:
+        return await interaction.followup.send(f"No usage recorded.\n{cache_line}", ephemeral=True)
+    lines = [cache_line,
+             f"{group_by.value}: input / output / cached tokens, images, tts characters"]
+    for key, input_tokens, output_tokens, cached_tokens, image_calls, tts_characters in rows:
+        if group_by.value == "channel_id":
+            channel = client.get_channel(key)
+            key = f"#{channel.name}" if channel is not None else key
+        elif group_by.value == "user_id":
+            user = client.get_user(key)
+            key = user.name if user is not None else key
+        lines.append(f"{key}: {input_tokens} / {output_tokens} / {cached_tokens}, "
+                     f"{image_calls}, {tts_characters}")
+    usage_text = "\n".join(lines)
+    if len(usage_text) <= MAX_MESSAGE_SIZE:
+        return await interaction.followup.send(usage_text, ephemeral=True)
+    usage_file = discord.File(
+        fp=BytesIO(usage_text.encode()), filename="usage.txt")
+    await interaction.followup.send(file=usage_file, ephemeral=True)
+
+
+@client.tree.command(name="profile", description="Profile the bot for some seconds (admin only).")
+@discord.app_commands.describe(
+    seconds="How long to profile (default 10)"
+)
+async def profile(interaction: discord.Interaction, seconds: int = 10):
+    """Profile the event loop and return the hot spots."""
+    if ADMIN_USER_ID is not None and interaction.user.id != int(ADMIN_USER_ID):
+        return await interaction.response.send_message(
+            "You do not have permission to use this command.", ephemeral=True)
+    if not 0 < seconds <= MAX_PROFILE_DURATION:
+        return await interaction.response.send_message(
+            f"Profile duration must be between 1 and {MAX_PROFILE_DURATION} seconds.", ephemeral=True)
+    await interaction.response.defer(ephemeral=True, thinking=True)
+    bot_logger.info(
+        f"Profiling for {seconds} seconds, requested by user {interaction.user.name} ({interaction.user.id})")
+    report = await profile_loop(seconds)
+    report_file = discord.File(
+        fp=BytesIO(report.encode()), filename="profile.txt")
+    await interaction.followup.send(
+        f"Max event loop lag since start: {loop_watchdog.max_lag:.3f} seconds",
+        file=report_file, ephemeral=True)
+
+
 @client.tree.command(name="config", description="Set a configuration option for the current channel.")
 @discord.app_commands.describe(
     option="The configuration option to set",
@@ -255,8 +380,11 @@ async def config_error(interaction: discord.Interaction, error: discord.app_comm
 @client.event
 async def on_ready():
     bot_logger.info(f'We have logged in as {client.user}')
+    loop_watchdog.start()
+    usage_ledger.start()
     await client.tree.sync()
     bot_logger.info(f'Synced all commands')
+    await chatgpt.start()
 
 
 @client.event
@@ -273,70 +401,254 @@ async def on_message(message: discord.Message):
         bot_logger.debug("Not my business")
         return
 
+    start_generation(message)
+
+
+@client.event
+async def on_message_delete(message: discord.Message):
+    if cancel_generation(message.channel.id, message.id) is not None:
+        bot_logger.info(
+            f"Prompt {message.id} deleted, cancelled generation in channel {message.channel.name}")
+
+
+@client.event
+async def on_raw_message_delete(payload: discord.RawMessageDeleteEvent):
+    # raw event, also covers messages that are no longer cached
+    await forget_messages(payload.channel_id, {payload.message_id})
+
+
+@client.event
+async def on_message_edit(before: discord.Message, after: discord.Message):
+    if before.content == after.content:
+        return  # embed or pin update, prompt unchanged
+    cancelled_task = cancel_generation(after.channel.id, after.id)
+    if cancelled_task is None:
+        return
+    bot_logger.info(
+        f"Prompt {after.id} edited, regenerating in channel {after.channel.name}")
+    # let the old task stop playback and leave the voice channel first
+    await asyncio.gather(cancelled_task, return_exceptions=True)
+    if ignore_message(after):
+        bot_logger.debug("Edited message no longer my business")
+        return
+    start_generation(after)
+
+
+def start_generation(message: discord.Message) -> asyncio.Task:
+    '''Starts the reply generation for a message and tracks it until done'''
+    channel_tasks = generation_tasks.setdefault(message.channel.id, dict())
+    task = asyncio.create_task(generate_reply(message))
+    channel_tasks[message.id] = task
+    task.add_done_callback(
+        lambda done_task: forget_generation(message.channel.id, message.id, done_task))
+    return task
+
+
+def cancel_generation(channel_id: int, message_id: int) -> Optional[asyncio.Task]:
+    '''Cancels an in-flight generation, returns its task if one was running'''
+    task = generation_tasks.get(channel_id, {}).pop(message_id, None)
+    if task is None or task.done():
+        return None
+    task.cancel()
+    return task
+
+
+def forget_generation(channel_id: int, message_id: int, task: asyncio.Task) -> None:
+    channel_tasks = generation_tasks.get(channel_id)
+    if channel_tasks is None:
+        return
+    # an edit may already have replaced the task for this message
+    if channel_tasks.get(message_id) is task:
+        del channel_tasks[message_id]
+    if len(channel_tasks) == 0:
+        del generation_tasks[channel_id]
+
+
+async def generate_reply(message: discord.Message):
     bot_logger.debug("Working...")
     async with message.channel.typing():
         response = None
         images = None
+        history_parameters = dict()
+        message_history = None
+        generation_parameters = dict()
+        request_sent = False
+        usage_recorded = False
         try:
+            budget_reason = usage_ledger.check_budget(
+                message.channel.id, message.author.id)
+            if budget_reason is not None:
+                raise RuntimeError(budget_reason)
+
             # generate ChatGPT prompt
             channel_config = await check_channel_config(message.channel)
 
-            history_parameters = dict()
-            generation_parameters = dict()
-
             history_parameters = {key: channel_config.get(
                 key, None) if channel_config is not None else None
                 for key in
                 [key["name"] for key in PARAMETER_LIST if key["category"] == "history"]}
 
             message_history = await generate_messagehistory(
-                channel=message.channel, **history_parameters)
+                channel=message.channel, user_id=message.author.id, **history_parameters)
 
             generation_parameters = {key: channel_config.get(
                 key, None) if channel_config is not None else None
                 for key in
                 [key["name"] for key in PARAMETER_LIST if key["category"] == "generation"]}
 
-            response, images = await chatgpt.get_response_async(message_history, **generation_parameters)
-
-            # check if user is in voice -> generate TTS if funds available
-            if channel_config is not None and \
-                    "voice" in channel_config and channel_config["voice"] and \
-                    message.author.voice and message.author.voice.channel:
-                voice_client = await message.author.voice.channel.connect()
-                try:
-                    if elevenlabs.get_character_remaining() > len(response):
-                        text_bytes = elevenlabs.get_voice_bytes(response)
-                        text_bytes_io = BytesIO(text_bytes)
-                        ffmpeg, ffprobe = run.get_or_fetch_platform_executables_else_raise()
-                        voice_client.play(discord.FFmpegPCMAudio(
-                            text_bytes_io, executable=ffmpeg, pipe=True))
-                        while voice_client.is_playing():
-                            await asyncio.sleep(1)
-                        elevenlabs.remove_history(response)
-                    else:
-                        # say not enough funds
-                        voice_client.play(discord.FFmpegPCMAudio(
-                            "not_enough_tokens.mp3", pipe=True))
-                    while voice_client.is_playing():
-                        pass
-                except Exception as e:
-                    bot_logger.error("Cannot play voice", e)
-                    error_embed = discord.Embed(
-                        title="Error playing voice", description=f"```{str(e)}```", color=discord.Color.red())
-                    await message.channel.send(embed=error_embed)
-                await voice_client.disconnect()
+            voice_client = None
+            speech = None
+            playback = None
+            try:
+                # check if user is in voice -> speak the reply while it is generated if funds available
+                if channel_config is not None and \
+                        "voice" in channel_config and channel_config["voice"] and \
+                        message.author.voice and message.author.voice.channel:
+                    try:
+                        voice_client = await message.author.voice.channel.connect()
+                        speech, playback = await start_speech(
+                            message, voice_client)
+                    except Exception as e:
+                        bot_logger.error("Cannot play voice", e)
+                        error_embed = discord.Embed(
+                            title="Error playing voice", description=f"```{str(e)}```", color=discord.Color.red())
+                        await message.channel.send(embed=error_embed)
+
+                request_sent = True
+                response, images, response_usage = await chatgpt.get_response_async(
+                    message_history, on_text_delta=speech.feed if speech is not None else None,
+                    **generation_parameters)
+                usage_ledger.record(message.channel.id,
+                                    message.author.id, **response_usage)
+                usage_recorded = True
+
+                if speech is not None:
+                    await speech.finish()
+                if playback is not None:
+                    playback_result, = await asyncio.gather(playback, return_exceptions=True)
+                    if isinstance(playback_result, Exception):
+                        bot_logger.error(f"Cannot play voice: {playback_result}")
+                if speech is not None:
+                    await asyncio.to_thread(remove_voice_history, speech.spoken)
+            finally:
+                if speech is not None:
+                    speech.cancel()
+                if voice_client is not None:
+                    voice_client.stop()
+                    await voice_client.disconnect()
+        except asyncio.CancelledError:
+            bot_logger.debug(f"Generation for message {message.id} cancelled")
+            if request_sent and not usage_recorded:
+                # the request may already be billed, count at least its input
+                record_cancelled_usage(
+                    message, message_history, generation_parameters.get("model_version"))
+            raise
+        except CircuitOpenError as e:
+            bot_logger.warning(f"Skipping generation: {e}")
+            error_embed = discord.Embed(
+                title="OpenAI unavailable", description=str(e), color=discord.Color.orange())
+            await message.channel.send(embed=error_embed)
         except Exception as e:
             bot_logger.error("Cannot generate message", e)
             error_embed = discord.Embed(
                 title="Error on_message", description=f"```{str(e)}```", color=discord.Color.red())
             await message.channel.send(embed=error_embed)
     if response is not None:
-        await send_message_blocks(message.channel, response)
+        reply_blocks = await send_message_blocks(message.channel, response)
+        if history_parameters.get("memory_count"):
+            await remember_exchange(message, reply_blocks, response)
     if images is not None and len(images) > 0:
         await send_images(message.channel, images)
 
 
+def record_cancelled_usage(message: discord.Message, message_history: List[Dict], model_version: Optional[str]) -> None:
+    try:
+        input_tokens = chatgpt.calculate_tokens(message_history, model_version)
+    except Exception as e:
+        bot_logger.warning(f"Cannot estimate tokens of cancelled generation: {e}")
+        return
+    usage_ledger.record(message.channel.id, message.author.id,
+                        model_version if model_version is not None else MODEL_DEFAULT,
+                        input_tokens=input_tokens)
+
+
+def record_embedding_usage(channel_id: int, user_id: int, usage: Optional[Dict]) -> None:
+    if usage is not None:
+        usage_ledger.record(channel_id, user_id, **usage)
+
+
+async def forget_messages(channel_id: int, message_ids: Set[int]) -> None:
+    '''Removes deleted messages from the long-term memory of the channel'''
+    try:
+        await channel_memory.forget(channel_id, message_ids)
+    except Exception as e:
+        bot_logger.warning(f"Cannot forget deleted messages: {e}")
+
+
+async def remember_exchange(message: discord.Message, reply_blocks: List[discord.Message], response: str) -> None:
+    '''Stores prompt and reply in the long-term memory of the channel'''
+    try:
+        record_embedding_usage(message.channel.id, message.author.id, await channel_memory.remember(
+            message.channel.id, message.id, "user", message.content))
+        # the reply is stored under its last block, deleting any block forgets it
+        record_embedding_usage(message.channel.id, message.author.id, await channel_memory.remember(
+            message.channel.id, reply_blocks[-1].id, "assistant", response,
+            block_ids=[block.id for block in reply_blocks]))
+    except Exception as e:
+        bot_logger.warning(f"Cannot remember message {message.id}: {e}")
+
+
+async def play_audio(voice_client: discord.VoiceClient, source: discord.AudioSource) -> None:
+    '''Plays a source and waits until it finished without polling'''
+    finished = asyncio.Event()
+    loop = asyncio.get_running_loop()
+
+    def after_playing(error: Optional[Exception]):
+        if error is not None:
+            bot_logger.error(f"Voice playback failed: {error}")
+        loop.call_soon_threadsafe(finished.set)
+
+    voice_client.play(source, after=after_playing)
+    await finished.wait()
+
+
+async def start_speech(message: discord.Message, voice_client: discord.VoiceClient) \
+        -> Tuple[Optional[SpeechPipeline], Optional[asyncio.Task]]:
+    '''Starts playback in the voice channel, returns the pipeline to feed the reply into'''
+    voice_characters_left = await asyncio.to_thread(elevenlabs.get_character_remaining)
+    if usage_ledger.check_budget(message.channel.id, message.author.id, 1) is not None or \
+            voice_characters_left <= 0:
+        # say not enough funds
+        if not_enough_tokens_audio is None:
+            return None, None
+        return None, asyncio.create_task(
+            play_audio(voice_client, OggOpusSource(not_enough_tokens_audio)))
+
+    def allow_segment(segment: str) -> bool:
+        nonlocal voice_characters_left
+        if len(segment) > voice_characters_left or \
+                usage_ledger.check_budget(message.channel.id, message.author.id, len(segment)) is not None:
+            return False
+        voice_characters_left -= len(segment)
+        usage_ledger.record(message.channel.id, message.author.id,
+                            tts_characters=len(segment))
+        return True
+
+    speech = SpeechPipeline(elevenlabs, allow_segment=allow_segment)
+    playback = asyncio.create_task(play_audio(voice_client, speech.source))
+    # if playback ends early nothing frees the queued clips, stop feeding the pipeline
+    playback.add_done_callback(lambda _: speech.cancel())
+    return speech, playback
+
+
+def remove_voice_history(segments: List[str]) -> None:
+    for segment in segments:
+        try:
+            elevenlabs.remove_history(segment)
+        except Exception as e:
+            bot_logger.warning(f"Cannot remove voice history: {e}")
+
+
 @client.event
 async def on_raw_reaction_add(payload: discord.RawReactionActionEvent):
     cross_reaction = "\u274c"
@@ -370,6 +682,8 @@ async def on_raw_reaction_add(payload: discord.RawReactionActionEvent):
                     deletion_messages_list.add(message)
             await guild_channel.delete_messages(deletion_messages_list)
             bot_logger.info(f"Deleted {len(deletion_messages_list)} messages!")
+            await forget_messages(guild_channel.id,
+                                  {message.id for message in deletion_messages_list})
     elif (payload.emoji.name == exclamation_reaction) and \
             (ADMIN_USER_ID is None or payload.user_id == int(ADMIN_USER_ID)):
         pass
@@ -377,7 +691,9 @@ async def on_raw_reaction_add(payload: discord.RawReactionActionEvent):
         bot_logger.debug("Reaction added")
 
 
-async def send_message_blocks(channel: discord.TextChannel, content: str):
+async def send_message_blocks(channel: discord.TextChannel, content: str) -> List[discord.Message]:
+    '''Sends content split into blocks, returns the sent messages'''
+    sent_messages: List[discord.Message] = []
     remaining_content = content
     while len(remaining_content) > MAX_MESSAGE_SIZE:
         current_block = remaining_content[:MAX_MESSAGE_SIZE]
@@ -407,8 +723,9 @@ async def send_message_blocks(channel: discord.TextChannel, content: str):
             remaining_content = remaining_content[len(current_block):]
         bot_logger.info(f"Sending message {(math.ceil(len(content)-len(remaining_content))/MAX_MESSAGE_SIZE)}"
                         f"/{math.ceil(len(content)/MAX_MESSAGE_SIZE)}")
-        await channel.send(current_block)
-    await channel.send(remaining_content)
+        sent_messages.append(await channel.send(current_block))
+    sent_messages.append(await channel.send(remaining_content))
+    return sent_messages
 
 
 async def send_images(channel: discord.TextChannel, images: List):
@@ -485,6 +802,16 @@ async def check_channel_config(channel: discord.TextChannel) -> dict:
         bot_logger.debug(
             f"Using image count max: {description_json['image_count_max']}")
 
+    if "memory_count" in description_json:
+        if description_json["memory_count"] == 0:
+            description_json["memory_count"] = None
+        elif description_json["memory_count"] not in range(1, MAX_MEMORY_COUNT + 1):
+            raise ValueError("Error channel_config memory_count",
+                             f"Invalid memory count: {description_json['memory_count']}."
+                             f"\nAllowed values: 1-{MAX_MEMORY_COUNT}, 0 for off")
+        bot_logger.debug(
+            f"Using memory count: {description_json['memory_count']}")
+
     if "system_message" in description_json:
         bot_logger.debug(
             f"Using system message: {description_json['system_message']}")
@@ -496,6 +823,10 @@ async def check_channel_config(channel: discord.TextChannel) -> dict:
     if "voice" in description_json:
         description_json["voice"] = ensure_bool(description_json["voice"])
 
+    if "response_cache" in description_json:
+        description_json["response_cache"] = ensure_bool(
+            description_json["response_cache"])
+
     if "tools" in description_json:
         # Currently only handles built-in tools
         if isinstance(description_json["tools"], list) and set(description_json["tools"]).issubset(ALLOWED_TOOLS):
@@ -547,14 +878,19 @@ def get_config_option(name: str):
     return None
 
 
-async def generate_messagehistory(channel: discord.TextChannel, system_message: str = None, sys_msg_order: str = None, history_length: int = None, image_count_max: int = None):
+async def generate_messagehistory(channel: discord.TextChannel, system_message: str = None, sys_msg_order: str = None, history_length: int = None, image_count_max: int = None, memory_count: int = None, user_id: int = None):
     bot_logger.debug("Reading message history")
     message_history: List[Dict] = []
     previous_author = 0
     image_count = 0
+    history_ids: Set[int] = set()
+    latest_prompt = None
     async for message in channel.history(limit=history_length):
+        history_ids.add(message.id)
         if message.content.startswith("!!") or len(message.content) < 2:
             continue
+        if latest_prompt is None and message.author.id != client.user.id:
+            latest_prompt = message.content
         message_user = None
         if message.author is not client.user:
             message_user = message.author.display_name.strip().replace(" ", "")
@@ -609,6 +945,25 @@ async def generate_messagehistory(channel: discord.TextChannel, system_message:
     # reverse message history
     message_history.reverse()
 
+    # recall older messages beyond the history window
+    if memory_count is not None and history_length is not None and latest_prompt is not None:
+        try:
+            recalled, recall_usage = await channel_memory.recall(
+                channel.id, latest_prompt, memory_count, history_ids)
+            record_embedding_usage(channel.id, user_id, recall_usage)
+        except Exception as e:
+            bot_logger.warning(f"Cannot recall older messages: {e}")
+            recalled = []
+        if len(recalled) > 0:
+            bot_logger.debug(f"Recalled {len(recalled)} older messages")
+            # cap every snippet so recall costs a fixed amount of prompt tokens
+            recalled_text = "\n".join(
+                f"{entry['role']}: {truncate_text(entry['text'], MAX_RECALL_CHARACTERS)}"
+                for entry in recalled)
+            message_history.insert(0, {
+                "role": "system",
+                "content": "Earlier messages from this conversation that may be relevant:\n" + recalled_text})
+
     if system_message is not None:
         if sys_msg_order == "first":
             message_history.insert(
@@ -620,6 +975,12 @@ async def generate_messagehistory(channel: discord.TextChannel, system_message:
     return message_history
 
 
+def truncate_text(text: str, max_characters: int) -> str:
+    if len(text) <= max_characters:
+        return text
+    return text[:max_characters].rsplit(" ", 1)[0] + " ..."
+
+
 def ignore_message(message: discord.Message) -> bool:
     '''Checks for bot account,
     chat inside certain guild with category,
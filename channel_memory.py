@@ -0,0 +1,242 @@
+import asyncio
+import hashlib
+import json
+import os
+import re
+import threading
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+import numpy as np
+from logging import getLogger
+
+memory_logger = getLogger(__name__)
+
+# returns one vector per text and the usage to record, None if the embedder is free
+Embedder = Callable[[List[str]], Awaitable[Tuple[List[List[float]], Optional[Dict]]]]
+
+MAX_EMBEDDING_CHARACTERS = 8000
+INITIAL_CAPACITY = 256
+RECENT_VECTOR_COUNT = 32
+DELETED_ID = -1
+
+
+class HashingEmbedder:
+    '''Local stand-in for the embeddings API, hashes words into a fixed size vector'''
+
+    def __init__(self, dimension: int = 256) -> None:
+        self.dimension = dimension
+
+    async def __call__(self, texts: List[str]) -> Tuple[List[List[float]], Optional[Dict]]:
+        vectors = np.zeros((len(texts), self.dimension), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for word in re.findall(r"\w+", text.lower()):
+                digest = hashlib.blake2b(word.encode(), digest_size=8).digest()
+                vectors[row, int.from_bytes(digest, "little") % self.dimension] += 1.0
+        return vectors.tolist(), None
+
+
+class ChannelVectors:
+    '''Embeddings of one channel in a memory-mapped float32 matrix,
+    with message id, role and text of each row in a jsonl file next to it.
+    Replies split over several messages keep the other ids in block_ids.
+    Blocking, meant to be used from a worker thread'''
+
+    def __init__(self, directory: Path, dimension: int, embedder_name: str) -> None:
+        directory.mkdir(parents=True, exist_ok=True)
+        self.__vectors_path = directory / "vectors.f32"
+        self.__entries_path = directory / "entries.jsonl"
+        self.__dimension = dimension
+        self.__check_metadata(directory / "meta.json", embedder_name)
+
+        self.entries: List[Dict] = list()
+        if self.__entries_path.exists():
+            with open(self.__entries_path, "r", encoding="utf-8") as entries_file:
+                self.entries = [json.loads(line) for line in entries_file if line.strip()]
+        if self.__vectors_path.exists() and \
+                self.__vectors_path.stat().st_size < len(self.entries) * dimension * 4:
+            raise ValueError(f"Memory store {directory} has fewer vectors than entries")
+        self.__capacity = 0
+        self.__matrix = None
+        self.__message_ids = np.empty(0, dtype=np.int64)
+        self.__resize(max(INITIAL_CAPACITY, len(self.entries)))
+        self.__message_ids[:len(self.entries)] = [
+            DELETED_ID if entry.get("deleted") else entry["message_id"] for entry in self.entries]
+        # every message id of an entry, including block_ids -> row
+        self.__rows_by_id: Dict[int, int] = dict()
+        for row, entry in enumerate(self.entries):
+            if not entry.get("deleted"):
+                self.__index_entry(row, entry)
+
+    def __check_metadata(self, metadata_path: Path, embedder_name: str) -> None:
+        '''Refuses to open vectors written with another embedder or row width'''
+        metadata = {"embedder": embedder_name, "dimension": self.__dimension}
+        if metadata_path.exists():
+            with open(metadata_path, "r", encoding="utf-8") as metadata_file:
+                stored = json.load(metadata_file)
+            if stored != metadata:
+                raise ValueError(
+                    f"Memory store {metadata_path.parent} was written with {stored}, not {metadata}")
+        else:
+            with open(metadata_path, "w", encoding="utf-8") as metadata_file:
+                json.dump(metadata, metadata_file)
+
+    def __resize(self, capacity: int) -> None:
+        if self.__matrix is not None:
+            self.__matrix.flush()
+            del self.__matrix
+        with open(self.__vectors_path, "a+b") as vectors_file:
+            if vectors_file.seek(0, 2) < capacity * self.__dimension * 4:
+                vectors_file.truncate(capacity * self.__dimension * 4)
+        self.__matrix = np.memmap(self.__vectors_path, dtype=np.float32, mode="r+",
+                                  shape=(capacity, self.__dimension))
+        message_ids = np.full(capacity, DELETED_ID, dtype=np.int64)
+        message_ids[:self.__capacity] = self.__message_ids[:self.__capacity]
+        self.__message_ids = message_ids
+        self.__capacity = capacity
+
+    def __index_entry(self, row: int, entry: Dict) -> None:
+        self.__rows_by_id[entry["message_id"]] = row
+        for block_id in entry.get("block_ids", []):
+            self.__rows_by_id[block_id] = row
+
+    def append(self, vector: np.ndarray, entry: Dict) -> None:
+        count = len(self.entries)
+        if count == self.__capacity:
+            self.__resize(self.__capacity * 2)
+        self.__matrix[count] = vector
+        self.__message_ids[count] = entry["message_id"]
+        self.entries.append(entry)
+        self.__index_entry(count, entry)
+        with open(self.__entries_path, "a", encoding="utf-8") as entries_file:
+            entries_file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+    def forget(self, message_ids: Set[int]) -> int:
+        '''Zeroes the rows of the given messages and drops their text, returns the amount'''
+        rows = sorted({self.__rows_by_id[message_id]
+                       for message_id in message_ids if message_id in self.__rows_by_id})
+        if len(rows) == 0:
+            return 0
+        self.__matrix[rows] = 0.0
+        self.__matrix.flush()
+        self.__message_ids[rows] = DELETED_ID
+        for row in rows:
+            entry = self.entries[row]
+            for message_id in [entry["message_id"]] + entry.get("block_ids", []):
+                self.__rows_by_id.pop(message_id, None)
+            self.entries[row] = {"message_id": entry["message_id"], "deleted": True}
+        # rows stay in place so the jsonl lines keep matching the matrix
+        temporary_path = self.__entries_path.with_suffix(".tmp")
+        with open(temporary_path, "w", encoding="utf-8") as entries_file:
+            for entry in self.entries:
+                entries_file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        os.replace(temporary_path, self.__entries_path)
+        return len(rows)
+
+    def search(self, query: np.ndarray, k: int, exclude_ids: Set[int]) -> List[Dict]:
+        '''Returns up to k entries with the highest cosine similarity, best first'''
+        count = len(self.entries)
+        if count == 0 or k <= 0:
+            return []
+        # rows are stored normalized, so the dot product is the cosine similarity
+        scores = np.asarray(self.__matrix[:count] @ query)
+        excluded = self.__message_ids[:count] == DELETED_ID
+        if len(exclude_ids) > 0:
+            excluded |= np.isin(self.__message_ids[:count], list(exclude_ids))
+        scores[excluded] = -np.inf
+        k = min(k, count)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [self.entries[index] for index in top if scores[index] > 0]
+
+
+class ChannelMemory:
+    '''Long-term memory per channel, recalls older messages by similarity to a query.
+    Stores are kept per embedder and dimension, switching embedders starts a new store'''
+
+    def __init__(self, embed: Embedder, dimension: int, embedder_name: str, directory: str = "data/memory") -> None:
+        self.__embed = embed
+        self.__dimension = dimension
+        self.__embedder_name = embedder_name
+        self.__directory = Path(directory)
+        self.__channels: Dict[int, ChannelVectors] = dict()
+        # file and matrix work runs in worker threads, one at a time
+        self.__lock = threading.Lock()
+        # a recalled prompt is usually remembered right after, avoid embedding it twice
+        self.__recent_vectors: Dict[str, np.ndarray] = dict()
+
+    def __channel_directory(self, channel_id: int) -> Path:
+        return self.__directory / str(channel_id) / f"{self.__embedder_name}-{self.__dimension}"
+
+    def __get_channel(self, channel_id: int) -> ChannelVectors:
+        if channel_id not in self.__channels:
+            self.__channels[channel_id] = ChannelVectors(
+                self.__channel_directory(channel_id), self.__dimension, self.__embedder_name)
+        return self.__channels[channel_id]
+
+    async def __embed_normalized(self, text: str) -> Tuple[np.ndarray, Optional[Dict]]:
+        if text in self.__recent_vectors:
+            return self.__recent_vectors[text], None
+        vectors, usage = await self.__embed([text[:MAX_EMBEDDING_CHARACTERS]])
+        vector = np.asarray(vectors[0], dtype=np.float32)
+        if vector.shape != (self.__dimension,):
+            raise ValueError(
+                f"Embedding has shape {vector.shape}, expected ({self.__dimension},)")
+        norm = np.linalg.norm(vector)
+        vector = vector / norm if norm > 0 else vector
+        if len(self.__recent_vectors) >= RECENT_VECTOR_COUNT:
+            del self.__recent_vectors[next(iter(self.__recent_vectors))]
+        self.__recent_vectors[text] = vector
+        return vector, usage
+
+    def __append(self, channel_id: int, vector: np.ndarray, entry: Dict) -> None:
+        with self.__lock:
+            self.__get_channel(channel_id).append(vector, entry)
+
+    def __search(self, channel_id: int, query: np.ndarray, k: int, exclude_ids: Set[int]) -> List[Dict]:
+        with self.__lock:
+            return self.__get_channel(channel_id).search(query, k, exclude_ids)
+
+    def __is_empty(self, channel_id: int) -> bool:
+        with self.__lock:
+            if channel_id not in self.__channels and \
+                    not self.__channel_directory(channel_id).exists():
+                return True
+            return len(self.__get_channel(channel_id).entries) == 0
+
+    def __forget(self, channel_id: int, message_ids: Set[int]) -> int:
+        with self.__lock:
+            if channel_id not in self.__channels and \
+                    not self.__channel_directory(channel_id).exists():
+                return 0
+            return self.__get_channel(channel_id).forget(message_ids)
+
+    async def remember(self, channel_id: int, message_id: int, role: str, text: str,
+                       block_ids: List[int] = None) -> Optional[Dict]:
+        '''Stores a message, block_ids are further messages holding the same text.
+        Returns the embedding usage to record'''
+        if len(text.strip()) == 0:
+            return None
+        vector, usage = await self.__embed_normalized(text)
+        entry = {"message_id": message_id, "role": role, "text": text}
+        if block_ids:
+            entry["block_ids"] = [block_id for block_id in block_ids if block_id != message_id]
+        await asyncio.to_thread(self.__append, channel_id, vector, entry)
+        memory_logger.debug(
+            f"Remembered message {message_id} in channel {channel_id}")
+        return usage
+
+    async def recall(self, channel_id: int, text: str, k: int, exclude_ids: Set[int] = set()) \
+            -> Tuple[List[Dict], Optional[Dict]]:
+        '''Returns the k remembered messages most similar to text, skipping exclude_ids,
+        and the embedding usage to record'''
+        if await asyncio.to_thread(self.__is_empty, channel_id):
+            return [], None
+        query, usage = await self.__embed_normalized(text)
+        return await asyncio.to_thread(self.__search, channel_id, query, k, exclude_ids), usage
+
+    async def forget(self, channel_id: int, message_ids: Set[int]) -> None:
+        '''Removes deleted messages so they are never recalled again'''
+        forgotten = await asyncio.to_thread(self.__forget, channel_id, set(message_ids))
+        if forgotten > 0:
+            memory_logger.debug(
+                f"Forgot {forgotten} messages in channel {channel_id}")
@@ -0,0 +1,94 @@
+import asyncio
+import cProfile
+import io
+import pstats
+import sys
+import threading
+import time
+import traceback
+from typing import Optional
+from logging import getLogger
+
+watchdog_logger = getLogger(__name__)
+
+
+class LoopWatchdog:
+    '''Measures event loop lag and logs what blocks the loop.
+
+    A heartbeat coroutine stamps the time every interval, a monitor thread
+    dumps the stack of the loop thread once the stamp is older than threshold.'''
+
+    def __init__(self, threshold: float = 0.5, interval: float = 0.1) -> None:
+        self.__threshold = threshold
+        self.__interval = interval
+        self.__heartbeat = time.monotonic()
+        self.__loop_thread_id: Optional[int] = None
+        self.__heartbeat_task: Optional[asyncio.Task] = None
+        self.__monitor_thread: Optional[threading.Thread] = None
+        self.__stop_event = threading.Event()
+        self.max_lag = 0.0
+
+    def start(self) -> None:
+        '''Starts the heartbeat and monitor thread, safe to call multiple times'''
+        if self.__heartbeat_task is not None and not self.__heartbeat_task.done():
+            return
+        self.__loop_thread_id = threading.get_ident()
+        self.__heartbeat = time.monotonic()
+        self.__stop_event.clear()
+        self.__heartbeat_task = asyncio.get_running_loop().create_task(self.__beat())
+        self.__monitor_thread = threading.Thread(
+            target=self.__monitor, name="loop-watchdog", daemon=True)
+        self.__monitor_thread.start()
+
+    def stop(self) -> None:
+        self.__stop_event.set()
+        if self.__heartbeat_task is not None:
+            self.__heartbeat_task.cancel()
+
+    async def __beat(self) -> None:
+        while True:
+            expected = time.monotonic() + self.__interval
+            await asyncio.sleep(self.__interval)
+            lag = time.monotonic() - expected
+            self.max_lag = max(self.max_lag, lag)
+            if lag > self.__threshold:
+                watchdog_logger.warning(
+                    f"Event loop was blocked for {lag:.3f} seconds")
+            self.__heartbeat = time.monotonic()
+
+    def __monitor(self) -> None:
+        reported_heartbeat = None
+        while not self.__stop_event.wait(self.__threshold / 2):
+            heartbeat = self.__heartbeat
+            stalled = time.monotonic() - heartbeat - self.__interval
+            if stalled < self.__threshold or heartbeat == reported_heartbeat:
+                continue
+            # report each stall once, with the stack that is blocking right now
+            reported_heartbeat = heartbeat
+            frame = sys._current_frames().get(self.__loop_thread_id)
+            if frame is None:
+                continue
+            stack = "".join(traceback.format_stack(frame))
+            watchdog_logger.warning(
+                f"Event loop blocked for over {stalled:.3f} seconds in:\n{stack}")
+
+
+_profile_lock = asyncio.Lock()
+
+
+async def profile_loop(duration: float, limit: int = 40) -> str:
+    '''Profiles the event loop thread for duration seconds, returns the top hot spots.
+    Work handed to worker threads (asyncio.to_thread) is not included'''
+    async with _profile_lock:
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            await asyncio.sleep(duration)
+        finally:
+            profiler.disable()
+    output = io.StringIO()
+    output.write(f"Profiled event loop for {duration} seconds\n\n")
+    statistics = pstats.Stats(profiler, stream=output)
+    statistics.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(limit)
+    statistics.sort_stats(pstats.SortKey.TIME).print_stats(limit)
+    return output.getvalue()
@@ -0,0 +1,76 @@
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+from logging import getLogger
+
+cache_logger = getLogger(__name__)
+
+
+def normalize_content(content: Any) -> Any:
+    '''Strips surrounding and repeated whitespace from message text
+    and the query string from image URLs'''
+    if isinstance(content, str):
+        return " ".join(content.split())
+    if isinstance(content, list):
+        return [normalize_content(item) for item in content]
+    if isinstance(content, dict):
+        # attachment URLs carry expiring signatures in the query, the path is stable
+        return {key: value.split("?", 1)[0] if key == "image_url" and isinstance(value, str)
+                else normalize_content(value) for key, value in content.items()}
+    return content
+
+
+class ResponseCache:
+    '''Least recently used cache of responses, bounded by entry count, size and age.
+    Size counts text and base64 images, larger responses are not cached'''
+
+    def __init__(self, max_entries: int = 128, ttl: float = 3600.0, max_bytes: int = 32 * 1024 * 1024) -> None:
+        self.__max_entries = max_entries
+        self.__ttl = ttl
+        self.__max_bytes = max_bytes
+        self.__size = 0
+        self.__entries: OrderedDict[str, Tuple[float, str, List, int]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(message_history: List[Dict], model_version: str, temperature: Optional[float],
+                 tools: Optional[List], tool_choice: Optional[str]) -> str:
+        key_data = json.dumps({
+            "input": normalize_content(message_history),
+            "model": model_version, "temperature": temperature,
+            "tools": tools, "tool_choice": tool_choice
+        }, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(key_data.encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[Tuple[str, List]]:
+        '''Returns the cached text and images, None if missing or expired'''
+        entry = self.__entries.get(key)
+        if entry is not None and time.monotonic() - entry[0] > self.__ttl:
+            self.__remove(key)
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.__entries.move_to_end(key)
+        self.hits += 1
+        cache_logger.info(
+            f"Response cache hit ({self.hits} hits / {self.misses} misses)")
+        return entry[1], list(entry[2])
+
+    def put(self, key: str, output_text: str, images: List) -> None:
+        size = len(output_text) + sum(len(image) for image in images)
+        if size > self.__max_bytes:
+            cache_logger.debug(f"Not caching response of {size} bytes")
+            return
+        if key in self.__entries:
+            self.__remove(key)
+        self.__entries[key] = (time.monotonic(), output_text, list(images), size)
+        self.__size += size
+        while len(self.__entries) > self.__max_entries or self.__size > self.__max_bytes:
+            self.__remove(next(iter(self.__entries)))
+
+    def __remove(self, key: str) -> None:
+        self.__size -= self.__entries.pop(key)[3]
@@ -1,8 +1,88 @@
+import asyncio
+import queue
+import re
+import subprocess
+from io import BytesIO
+from threading import Event
+from typing import Callable, List, Optional, Tuple
+import discord
+from discord.oggparse import OggStream
 from elevenlabs.client import ElevenLabs
+from static_ffmpeg import run
 from logging import getLogger
 
 voice_logger = getLogger(__name__)
 
+# Ogg/Opus at Discord's native 48 kHz, packets can be sent without transcoding
+OUTPUT_FORMAT = "opus_48000_64"
+OPUS_SILENCE = b"\xf8\xff\xfe"
+# split after sentence punctuation or on line breaks
+SENTENCE_END = re.compile(r"(?<=[.!?:;])\s+|\n+")
+MIN_SEGMENT_LENGTH = 40
+
+
+class OggOpusSource(discord.AudioSource):
+    '''Passes the Opus packets of an Ogg stream straight to the voice client.
+    Expects 20 ms frames, the Opus default used by ElevenLabs and ffmpeg'''
+
+    def __init__(self, ogg_bytes: bytes) -> None:
+        self.__packets = (packet for packet in OggStream(BytesIO(ogg_bytes)).iter_packets()
+                          if not packet.startswith((b"OpusHead", b"OpusTags")))
+
+    def read(self) -> bytes:
+        return next(self.__packets, b"")
+
+    def is_opus(self) -> bool:
+        return True
+
+
+class QueuedOpusSource(discord.AudioSource):
+    '''Plays queued Ogg/Opus clips back to back without gaps.
+    Sends silence while the next clip is not synthesized yet, ends after close().
+    on_clip_finished is called from the player thread after each clip'''
+
+    def __init__(self, on_clip_finished: Callable[[], None] = None) -> None:
+        self.__clips: queue.SimpleQueue = queue.SimpleQueue()
+        self.__current: Optional[OggOpusSource] = None
+        self.__on_clip_finished = on_clip_finished
+
+    def put(self, ogg_bytes: bytes) -> None:
+        self.__clips.put(OggOpusSource(ogg_bytes))
+
+    def close(self) -> None:
+        self.__clips.put(None)
+
+    def read(self) -> bytes:
+        while True:
+            if self.__current is not None:
+                packet = self.__current.read()
+                if packet:
+                    return packet
+                self.__current = None
+                if self.__on_clip_finished is not None:
+                    self.__on_clip_finished()
+            try:
+                clip = self.__clips.get_nowait()
+            except queue.Empty:
+                return OPUS_SILENCE
+            if clip is None:
+                return b""
+            self.__current = clip
+
+    def is_opus(self) -> bool:
+        return True
+
+
+def encode_ogg_opus(path: str) -> bytes:
+    '''Transcodes an audio file to Ogg/Opus once, so it can be replayed without ffmpeg'''
+    ffmpeg, ffprobe = run.get_or_fetch_platform_executables_else_raise()
+    result = subprocess.run(
+        [ffmpeg, "-loglevel", "error", "-i", path, "-c:a", "libopus", "-b:a", "64k",
+         "-ar", "48000", "-ac", "2", "-frame_duration", "20", "-f", "ogg", "pipe:1"],
+        capture_output=True, check=True)
+    voice_logger.debug(f"Encoded {path} to {len(result.stdout)} bytes of Ogg/Opus")
+    return result.stdout
+
 
 class Voice:
     def __init__(self, token: str, name: str = "Glinda") -> None:
@@ -10,14 +90,17 @@ class Voice:
         self.__client = ElevenLabs(api_key=self.__api_key)
         self.__voice_name = name
 
-    def get_voice_bytes(self, prompt: str) -> bytes:
+    def get_voice_bytes(self, prompt: str, cancel_event: Optional[Event] = None, output_format: str = OUTPUT_FORMAT,
+                        check_remaining: bool = True) -> bytes:
+        '''Fetches Ogg/Opus audio for prompt, stops the download early once cancel_event is set'''
+        if not check_remaining:
+            return self.__generate(prompt, cancel_event, output_format)
         remaining = self.get_character_remaining()
         if remaining >= len(prompt):
             voice_logger.debug("Fetching audio from ElevenLabs")
             voice_logger.debug(
                 f"Using {len(prompt)} characters out of {remaining} remaining.")
-            audio_bytes = self.__client.generate(
-                prompt, voice=self.__voice_name)
+            audio_bytes = self.__generate(prompt, cancel_event, output_format)
             voice_logger.debug(
                 f"Remaining characters: {self.get_character_remaining()}")
             return audio_bytes
@@ -26,6 +109,18 @@ class Voice:
                                  f"(Needed: {len(prompt)} / Remaining: {remaining})")
         raise Exception("Unable to generate voice")
 
+    def __generate(self, prompt: str, cancel_event: Optional[Event], output_format: str) -> bytes:
+        audio_stream = self.__client.generate(
+            prompt, voice=self.__voice_name, output_format=output_format, stream=True)
+        audio_bytes = bytearray()
+        for chunk in audio_stream:
+            if cancel_event is not None and cancel_event.is_set():
+                audio_stream.close()  # closes the underlying HTTP response
+                voice_logger.debug("Audio generation cancelled")
+                raise InterruptedError("Voice generation cancelled")
+            audio_bytes.extend(chunk)
+        return bytes(audio_bytes)
+
     def get_voice_bytes_history(self, prompt: str) -> bytes:
         client = ElevenLabs(api_key=self.__api_key)
         for historyItem in client.history.get_all().items:
@@ -50,3 +145,107 @@ class Voice:
         voice_logger.info(
             f"Used up {current} out of {limit} characters ({percentage}%).")
         return limit - current
+
+
+class SpeechPipeline:
+    '''Splits streamed text into sentences and synthesizes them while the text is still generated.
+    Segments are synthesized concurrently and queued for playback in order.
+    At most max_queued clips wait in the source and max_pending segments wait for
+    synthesis, after that feed() blocks until playback catches up.
+    Once cancelled, e.g. because playback stopped, feed() and finish() do nothing'''
+
+    def __init__(self, voice: Voice, max_concurrent: int = 3, max_pending: int = 3, max_queued: int = 2,
+                 allow_segment: Callable[[str], bool] = None) -> None:
+        self.__voice = voice
+        loop = asyncio.get_running_loop()
+        self.__playback_slots = asyncio.Semaphore(max_queued)
+        self.source = QueuedOpusSource(
+            lambda: loop.call_soon_threadsafe(self.__playback_slots.release))
+        self.__allow_segment = allow_segment
+        self.__semaphore = asyncio.Semaphore(max_concurrent)
+        self.__pending: asyncio.Queue = asyncio.Queue(maxsize=max_pending)
+        self.__cancel_event = Event()
+        self.__text = ""
+        self.__segment = ""
+        self.__segment_count = 0
+        self.spoken: List[str] = list()
+        self.__feeder = asyncio.create_task(self.__feed_source())
+
+    @property
+    def cancelled(self) -> bool:
+        return self.__cancel_event.is_set()
+
+    async def feed(self, text_delta: str) -> None:
+        if self.cancelled:
+            return
+        self.__text += text_delta
+        *sentences, self.__text = SENTENCE_END.split(self.__text)
+        for sentence in sentences:
+            self.__segment += sentence + " "
+            # keep the first segment short to start speaking early
+            if len(self.__segment) >= MIN_SEGMENT_LENGTH or self.__segment_count == 0:
+                await self.__queue_segment()
+
+    async def finish(self) -> None:
+        '''Queues the remaining text and waits until everything is synthesized'''
+        if self.cancelled:
+            return
+        self.__segment += self.__text
+        self.__text = ""
+        await self.__queue_segment()
+        await self.__pending.put(None)
+        # the feeder is cancelled with the pipeline, that is no error for the caller
+        await asyncio.gather(self.__feeder, return_exceptions=True)
+
+    def cancel(self) -> None:
+        '''Stops synthesis and ends playback, safe to call multiple times'''
+        if self.cancelled:
+            return
+        self.__cancel_event.set()
+        self.__feeder.cancel()
+        while not self.__pending.empty():
+            item = self.__pending.get_nowait()
+            if item is not None:
+                item[1].cancel()
+        self.source.close()
+
+    async def __queue_segment(self) -> None:
+        segment = self.__segment.strip()
+        self.__segment = ""
+        if len(segment) == 0 or self.cancelled:
+            return
+        if self.__allow_segment is not None and not self.__allow_segment(segment):
+            voice_logger.debug(f"Skipping segment with {len(segment)} characters")
+            return
+        self.__segment_count += 1
+        task = asyncio.create_task(self.__synthesize(segment))
+        await self.__pending.put((segment, task))
+        if self.cancelled:
+            # cancel() drained the queue while we waited, nobody will play this
+            task.cancel()
+
+    async def __synthesize(self, segment: str) -> bytes:
+        async with self.__semaphore:
+            if self.cancelled:
+                raise InterruptedError("Voice generation cancelled")
+            return await asyncio.to_thread(self.__voice.get_voice_bytes, segment,
+                                           self.__cancel_event, check_remaining=False)
+
+    async def __feed_source(self) -> None:
+        try:
+            while True:
+                item: Optional[Tuple[str, asyncio.Task]] = await self.__pending.get()
+                if item is None:
+                    break
+                segment, task = item
+                try:
+                    audio_bytes = await task
+                except Exception as e:
+                    voice_logger.error(f"Cannot synthesize segment: {e}")
+                    continue
+                # wait until a queued clip finished playing
+                await self.__playback_slots.acquire()
+                self.source.put(audio_bytes)
+                self.spoken.append(segment)
+        finally:
+            self.source.close()
@@ -1,40 +1,135 @@
-from typing import List
-from openai import AsyncOpenAI, OpenAI
+import asyncio
+import math
+import random
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple, TypeVar
+import httpx
+from openai import APIConnectionError, APITimeoutError, AsyncOpenAI, InternalServerError, RateLimitError
 import tiktoken
+from response_cache import ResponseCache
 from logging import getLogger
 
 text_logger = getLogger(__name__)
 
+T = TypeVar("T")
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    '''Fails fast after repeated upstream failures until the cooldown passed'''
+
+    def __init__(self, failure_threshold: int = 5, cooldown: float = 30.0) -> None:
+        self.__failure_threshold = failure_threshold
+        self.__cooldown = cooldown
+        self.__failures = 0
+        self.__opened_at: Optional[float] = None
+        self.__trial_in_flight = False
+
+    def before_call(self) -> bool:
+        '''Raises CircuitOpenError while open, returns True if the call is the half-open trial'''
+        if self.__opened_at is None:
+            return False
+        remaining = self.__opened_at + self.__cooldown - time.monotonic()
+        if remaining > 0:
+            raise CircuitOpenError(
+                f"OpenAI is currently unreachable, try again in {math.ceil(remaining)} seconds.")
+        if self.__trial_in_flight:
+            raise CircuitOpenError(
+                "OpenAI is currently unreachable, checking if it is back.")
+        # half-open: let a single request through as a trial
+        self.__trial_in_flight = True
+        return True
+
+    def end_trial(self) -> None:
+        self.__trial_in_flight = False
+
+    def record_success(self) -> None:
+        self.__failures = 0
+        self.__opened_at = None
+
+    def record_failure(self) -> None:
+        self.__failures += 1
+        if self.__failures >= self.__failure_threshold:
+            if self.__opened_at is None:
+                text_logger.warning(
+                    f"OpenAI failed {self.__failures} times, opening circuit for {self.__cooldown} seconds")
+            self.__opened_at = time.monotonic()
+
 
 class Chat:
-    def __init__(self, token: str, model_version: str) -> None:
+    def __init__(self, token: str, model_version: str, max_connections: int = 20, keepalive_connections: int = 10,
+                 connect_timeout: float = 5.0, read_timeout: float = 120.0, generation_timeout: float = 600.0,
+                 max_retries: int = 3, response_cache: ResponseCache = None) -> None:
         self.__api_key = token
-        self.__client = OpenAI(api_key=self.__api_key)
-        self.__async_client = AsyncOpenAI(api_key=self.__api_key)
+        self.__http_client = httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(max_connections=max_connections,
+                                max_keepalive_connections=keepalive_connections,
+                                keepalive_expiry=120.0),
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout))
+        # the SDK retries connection errors, 408, 409, 429 and 5xx with exponential backoff,
+        # fine for listing models and embeddings
+        self.__async_client = AsyncOpenAI(api_key=self.__api_key, http_client=self.__http_client,
+                                          max_retries=max_retries)
+        # generations are billed even if the response times out, never resend them blindly
+        self.__generation_client = self.__async_client.with_options(
+            max_retries=0, timeout=httpx.Timeout(generation_timeout, connect=connect_timeout))
+        # streamed chunks keep arriving, a long silence means the stream stalled
+        self.__stream_client = self.__async_client.with_options(
+            max_retries=0, timeout=httpx.Timeout(read_timeout, connect=connect_timeout))
+        self.__max_retries = max_retries
+        self.__breaker = CircuitBreaker()
+        self.response_cache = response_cache if response_cache is not None else ResponseCache()
         self.__model_version = model_version
+        self.__warmed = False
+        self.__model_list: List[str] = list()
+        self.__model_refresh_task: Optional[asyncio.Task] = None
 
-    def get_completion(self, message_history: dict, model_version: str = None) -> str:
-        '''Fetches response from ChatGPT with entire message history'''
-        fetch_model_version = model_version if model_version is not None else self.__model_version
+    async def __call_upstream(self, request: Callable[[], Awaitable[T]]) -> T:
+        '''Sends an OpenAI request through the circuit breaker'''
+        trial = self.__breaker.before_call()
+        try:
+            result = await request()
+        except (APIConnectionError, APITimeoutError, InternalServerError, httpx.TransportError):
+            # streams raise httpx errors unwrapped while iterating
+            self.__breaker.record_failure()
+            raise
+        except Exception:
+            self.__breaker.record_success()  # upstream answered, e.g. a 400
+            raise
+        finally:
+            if trial:
+                self.__breaker.end_trial()
+        self.__breaker.record_success()
+        return result
 
-        text_logger.debug("Fetching response from ChatGPT")
-        completion = self.__client.chat.completions.create(
-            model=fetch_model_version, messages=message_history)
-
-        response = completion.choices[0].message.content
-
-        # text_logger.debug(response)
-        text_logger.info(f"Response with {len(response)} characters")
-        return response
+    async def __call_generation(self, request: Callable[[], Awaitable[T]]) -> T:
+        '''Sends a generation request, retrying only when it surely was not processed:
+        connection could not be established or rate limited'''
+        for attempt in range(self.__max_retries + 1):
+            try:
+                return await self.__call_upstream(request)
+            except (APIConnectionError, RateLimitError) as e:
+                not_sent = isinstance(e, RateLimitError) or \
+                    isinstance(e.__cause__, (httpx.ConnectError, httpx.ConnectTimeout))
+                if not not_sent or attempt == self.__max_retries:
+                    raise
+                delay = min(0.5 * 2 ** attempt, 8.0) * (1 + random.random() / 4)
+                text_logger.warning(
+                    f"Generation request failed ({type(e).__name__}), retrying in {delay:.1f} seconds")
+                await asyncio.sleep(delay)
 
     async def get_completion_async(self, message_history: dict, model_version: str = None, temperature: float = None) -> str:
         '''Fetches response from ChatGPT with entire message history'''
         fetch_model_version = model_version if model_version is not None else self.__model_version
 
         text_logger.debug("Fetching response from ChatGPT")
-        completion = await self.__async_client.chat.completions.create(
+        completion = await self.__call_generation(lambda: self.__generation_client.chat.completions.create(
             model=fetch_model_version, temperature=temperature,
-            messages=message_history)
+            messages=message_history))
 
         response = completion.choices[0].message.content
 
@@ -42,40 +137,141 @@ class Chat:
         text_logger.info(f"Response with {len(response)} characters")
         return response
 
-    async def get_response_async(self, message_history: dict, model_version: str = None, temperature: float = None, tools: List = None, tool_choice: str = None) -> str:
-        '''Fetches response from ChatGPT with entire message history'''
+    async def get_response_async(self, message_history: dict, model_version: str = None, temperature: float = None, tools: List = None, tool_choice: str = None,
+                                 on_text_delta: Callable[[str], Awaitable[None]] = None, response_cache: bool = None) -> Tuple[str, List, Dict]:
+        '''Fetches response from ChatGPT with entire message history.
+        Streams text to on_text_delta while generating if given.
+        With response_cache identical requests are answered from the cache.
+        Returns the text, generated images and token usage'''
         fetch_model_version = model_version if model_version is not None else self.__model_version
+        cache_key = None
+        if response_cache:
+            cache_key = ResponseCache.make_key(
+                message_history, fetch_model_version, temperature, tools, tool_choice)
+            cached = self.response_cache.get(cache_key)
+            if cached is not None:
+                output_text, image_list = cached
+                if on_text_delta is not None:
+                    await on_text_delta(output_text)
+                text_logger.info(
+                    f"Cached response with {len(output_text)} characters and {len(image_list)} images.")
+                return output_text, image_list, {"model": fetch_model_version}
+        parameters = {
+            "model": fetch_model_version, "temperature": temperature,
+            "tools": tools, "tool_choice": tool_choice,
+            "input": message_history
+        }
 
         text_logger.debug("Fetching response from ChatGPT")
-        response = await self.__async_client.responses.create(
-            model=fetch_model_version, temperature=temperature,
-            tools=tools, tool_choice=tool_choice,
-            input=message_history
-        )
+        if on_text_delta is None:
+            response = await self.__call_generation(
+                lambda: self.__generation_client.responses.create(**parameters))
+        else:
+            response = await self.__call_generation(
+                lambda: self.__stream_response(on_text_delta, parameters))
 
         image_list: List = [
             output.result for output in response.output if output.type == "image_generation_call"]
 
+        usage = {
+            "model": response.model,
+            "input_tokens": response.usage.input_tokens if response.usage else 0,
+            "output_tokens": response.usage.output_tokens if response.usage else 0,
+            "cached_tokens": response.usage.input_tokens_details.cached_tokens if response.usage else 0,
+            "image_calls": len(image_list)
+        }
+
+        if cache_key is not None:
+            self.response_cache.put(cache_key, response.output_text, image_list)
+
         text_logger.info(
             f"Response with {len(response.output_text)} characters and {len(image_list) if image_list is not None else 0} images.")
-        return response.output_text, image_list
+        return response.output_text, image_list, usage
+
+    async def __stream_response(self, on_text_delta: Callable[[str], Awaitable[None]], parameters: Dict):
+        '''Streams a response, leaving the block closes the HTTP stream on cancel'''
+        stream = await self.__stream_client.responses.create(stream=True, **parameters)
+        async with stream:
+            async for event in stream:
+                if event.type == "response.output_text.delta":
+                    await on_text_delta(event.delta)
+                elif event.type == "response.completed":
+                    return event.response
+                elif event.type in ("response.failed", "response.incomplete"):
+                    raise RuntimeError(
+                        f"Response {event.type.split('.')[1]}: {event.response.error or event.response.incomplete_details}")
+        raise RuntimeError("Response stream ended without completion")
 
-    def get_model_list(self) -> List[str]:
-        model_list = self.__client.models.list()._get_page_items()
+    async def get_embeddings_async(self, texts: List[str], model: str = "text-embedding-3-small") -> Tuple[List[List[float]], Dict]:
+        '''Fetches one embedding vector per text, returns the vectors and token usage'''
+        response = await self.__call_upstream(lambda: self.__async_client.embeddings.create(
+            model=model, input=texts))
+        usage = {
+            "model": model,
+            "input_tokens": response.usage.prompt_tokens if response.usage else 0
+        }
+        return [embedding.embedding for embedding in response.data], usage
+
+    async def fetch_model_list(self) -> List[str]:
+        '''Fetches the available models from OpenAI and updates the cache'''
+        model_page = await self.__call_upstream(self.__async_client.models.list)
         parsed_model_list: List[str] = list()
-        for model in model_list:
+        for model in model_page.data:
             parsed_model_list.append(model.id)
+        self.__model_list = parsed_model_list
         return parsed_model_list
 
-    def calculate_tokens(self, messages: dict) -> int:
+    async def get_model_list(self) -> List[str]:
+        '''Returns the cached model list, fetching it on first use'''
+        if len(self.__model_list) == 0:
+            return await self.fetch_model_list()
+        return self.__model_list
+
+    async def __refresh_model_list(self, interval: float) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.fetch_model_list()
+                text_logger.debug(
+                    f"Refreshed model list ({len(self.__model_list)} models)")
+            except Exception as e:
+                text_logger.warning(f"Cannot refresh model list: {e}")
+
+    async def start(self, refresh_interval: float = 3600.0) -> None:
+        '''Pre-warms the connection and starts the background model list refresh, safe to call multiple times'''
+        if not self.__warmed:
+            # HTTP/2 multiplexes every request over one connection, a single request warms it
+            self.__warmed = True
+            try:
+                await self.fetch_model_list()
+                text_logger.info("Warmed up OpenAI connection")
+            except Exception as e:
+                text_logger.warning(f"Cannot warm up OpenAI connection: {e}")
+        if self.__model_refresh_task is None or self.__model_refresh_task.done():
+            self.__model_refresh_task = asyncio.get_running_loop().create_task(
+                self.__refresh_model_list(refresh_interval))
+
+    async def close(self) -> None:
+        if self.__model_refresh_task is not None:
+            self.__model_refresh_task.cancel()
+        await self.__http_client.aclose()
+
+    def calculate_tokens(self, messages: dict, model_version: str = None) -> int:
         '''Calculates an estimate of the tokens used by message history'''
-        encoding = tiktoken.encoding_for_model(self.__model_version)
+        try:
+            encoding = tiktoken.encoding_for_model(
+                model_version if model_version is not None else self.__model_version)
+        except KeyError:
+            encoding = tiktoken.get_encoding("o200k_base")
         tokens_per_message = 3
         tokens_per_name = 1
         num_tokens = 0
         for message in messages:
             num_tokens += tokens_per_message
             for key, value in message.items():
+                if isinstance(value, list):
+                    # input_text / input_image parts, images are not estimated
+                    value = " ".join(part.get("text", "") for part in value)
                 num_tokens += len(encoding.encode(value))
                 if key == "name":
                     num_tokens += tokens_per_name
@@ -0,0 +1,154 @@
+import asyncio
+import sqlite3
+import time
+from datetime import date
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple
+from logging import getLogger
+
+usage_logger = getLogger(__name__)
+
+USAGE_COLUMNS = ["input_tokens", "output_tokens",
+                 "cached_tokens", "image_calls", "tts_characters"]
+GROUP_COLUMNS = ["channel_id", "user_id", "model"]
+
+
+class UsageLedger:
+    '''Records API usage per channel, user and model.
+
+    Entries are buffered in memory and written to SQLite in batches from a
+    worker thread. Daily totals are kept in memory so budget checks never
+    touch the database.'''
+
+    def __init__(self, database: str = "data/usage.sqlite3", batch_size: int = 20, flush_interval: float = 30.0,
+                 channel_token_budget: int = None, user_token_budget: int = None,
+                 channel_character_budget: int = None, user_character_budget: int = None) -> None:
+        self.__database = database
+        self.__batch_size = batch_size
+        self.__flush_interval = flush_interval
+        self.__token_budget = {"channel": channel_token_budget,
+                               "user": user_token_budget}
+        self.__character_budget = {"channel": channel_character_budget,
+                                   "user": user_character_budget}
+        self.__buffer: List[Tuple] = list()
+        self.__flush_lock = asyncio.Lock()
+        self.__flush_task: Optional[asyncio.Task] = None
+        # batch flushes run in the background, keep them referenced until done
+        self.__pending_flushes: Set[asyncio.Task] = set()
+        self.__day = date.today().isoformat()
+        # (scope, id) -> [tokens, characters] used today
+        self.__daily_usage: Dict[Tuple[str, int], List[int]] = dict()
+
+        Path(self.__database).parent.mkdir(parents=True, exist_ok=True)
+        with sqlite3.connect(self.__database) as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS usage ("
+                "timestamp REAL NOT NULL, day TEXT NOT NULL,"
+                " channel_id INTEGER, user_id INTEGER, model TEXT,"
+                " input_tokens INTEGER DEFAULT 0, output_tokens INTEGER DEFAULT 0,"
+                " cached_tokens INTEGER DEFAULT 0, image_calls INTEGER DEFAULT 0,"
+                " tts_characters INTEGER DEFAULT 0)")
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS usage_day ON usage (day)")
+        self.__load_daily_usage()
+
+    def __load_daily_usage(self) -> None:
+        '''Restores today's totals so a restart does not reset the budgets'''
+        with sqlite3.connect(self.__database) as connection:
+            for scope in ["channel", "user"]:
+                rows = connection.execute(
+                    f"SELECT {scope}_id, SUM(input_tokens + output_tokens), SUM(tts_characters)"
+                    f" FROM usage WHERE day = ? GROUP BY {scope}_id", (self.__day,))
+                for scope_id, tokens, characters in rows:
+                    self.__daily_usage[(scope, scope_id)] = [
+                        tokens or 0, characters or 0]
+
+    def __roll_day(self) -> None:
+        today = date.today().isoformat()
+        if today != self.__day:
+            usage_logger.debug(f"New usage day {today}, resetting budgets")
+            self.__day = today
+            self.__daily_usage.clear()
+
+    def record(self, channel_id: int, user_id: int, model: str = None,
+               input_tokens: int = 0, output_tokens: int = 0, cached_tokens: int = 0,
+               image_calls: int = 0, tts_characters: int = 0) -> None:
+        '''Adds a usage entry to the buffer and the daily totals'''
+        self.__roll_day()
+        self.__buffer.append((time.time(), self.__day, channel_id, user_id, model,
+                              input_tokens, output_tokens, cached_tokens,
+                              image_calls, tts_characters))
+        for key in [("channel", channel_id), ("user", user_id)]:
+            totals = self.__daily_usage.setdefault(key, [0, 0])
+            totals[0] += input_tokens + output_tokens
+            totals[1] += tts_characters
+        if len(self.__buffer) >= self.__batch_size:
+            flush_task = asyncio.get_running_loop().create_task(self.flush())
+            self.__pending_flushes.add(flush_task)
+            flush_task.add_done_callback(self.__pending_flushes.discard)
+
+    def check_budget(self, channel_id: int, user_id: int, characters: int = 0) -> Optional[str]:
+        '''Returns the reason if channel or user is out of budget for today, else None'''
+        self.__roll_day()
+        for scope, scope_id in [("channel", channel_id), ("user", user_id)]:
+            tokens_used, characters_used = self.__daily_usage.get(
+                (scope, scope_id), (0, 0))
+            token_budget = self.__token_budget[scope]
+            if token_budget is not None and tokens_used >= token_budget:
+                return f"Daily {scope} token budget used up ({tokens_used}/{token_budget})."
+            character_budget = self.__character_budget[scope]
+            if characters > 0 and character_budget is not None and \
+                    characters_used + characters > character_budget:
+                return f"Daily {scope} voice character budget used up ({characters_used}/{character_budget})."
+        return None
+
+    async def flush(self) -> None:
+        '''Writes buffered entries to the database off the event loop'''
+        async with self.__flush_lock:
+            if len(self.__buffer) == 0:
+                return
+            entries, self.__buffer = self.__buffer, list()
+            try:
+                await asyncio.to_thread(self.__write_entries, entries)
+                usage_logger.debug(f"Flushed {len(entries)} usage entries")
+            except Exception as e:
+                usage_logger.error(f"Cannot write usage entries: {e}")
+                self.__buffer = entries + self.__buffer
+
+    def __write_entries(self, entries: List[Tuple]) -> None:
+        with sqlite3.connect(self.__database) as connection:
+            connection.executemany(
+                "INSERT INTO usage (timestamp, day, channel_id, user_id, model, "
+                + ", ".join(USAGE_COLUMNS) + ") VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", entries)
+
+    async def __flush_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self.__flush_interval)
+            await self.flush()
+
+    def start(self) -> None:
+        '''Starts the periodic flush, safe to call multiple times'''
+        if self.__flush_task is None or self.__flush_task.done():
+            self.__flush_task = asyncio.get_running_loop().create_task(
+                self.__flush_periodically())
+
+    async def close(self) -> None:
+        if self.__flush_task is not None:
+            self.__flush_task.cancel()
+        await self.flush()
+
+    async def query(self, group_by: str = "channel_id", days: int = 1) -> List[Tuple]:
+        '''Aggregates usage of the last days grouped by channel_id, user_id or model'''
+        if group_by not in GROUP_COLUMNS:
+            raise ValueError(f"Cannot group usage by {group_by}")
+        await self.flush()
+        return await asyncio.to_thread(self.__query_totals, group_by, days)
+
+    def __query_totals(self, group_by: str, days: int) -> List[Tuple]:
+        since = time.time() - days * 86400
+        with sqlite3.connect(self.__database) as connection:
+            return connection.execute(
+                f"SELECT {group_by}, " +
+                ", ".join(f"SUM({column})" for column in USAGE_COLUMNS) +
+                f" FROM usage WHERE timestamp >= ? GROUP BY {group_by}"
+                " ORDER BY SUM(input_tokens + output_tokens) DESC", (since,)).fetchall()